@@ -1,11 +1,25 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
 import json
+import collections
+import csv
+import io
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import hmac
+import inspect
+import random
 import aiohttp
 import asyncio
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
+import sqlite3
+import time
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -16,9 +30,139 @@ GITHUB_TOKEN = os.getenv("GITHUB_TOKEN", "")
 GIST_ID = os.getenv("GIST_ID", "")
 MENU_DATA_FILE = "menu_data.json"
 ADMIN_PIN = os.getenv("ADMIN_PIN", "1234")  # Значение по умолчанию "1234", если не задано в .env
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gist")  # Локальное хранилище рядом с Gist: "gist" (JSON-файлы) или "sqlite" (с журналом изменений)
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE", "bot_state.db")
+
+# --- Последнее сохраненное в Gist состояние (сериализованное содержимое файлов) ---
+last_persisted_files = {}  # Имя файла -> содержимое, которое сейчас лежит в Gist
+gist_save_stats = {
+    "requests_sent": 0,        # Отправлено PATCH-запросов
+    "requests_suppressed": 0,  # Пропущено запросов (состояние не изменилось)
+    "bytes_saved": 0,          # Сэкономлено байт по сравнению с полной отправкой с отступами
+}
+
+# --- Профилирование обработчиков ---
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.1"))  # Доля профилируемых обновлений
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "20"))  # Сколько самых медленных трасс хранить
+PROFILE_OUTPUT_FILE = os.getenv("PROFILE_OUTPUT_FILE", "profile_traces.json")
+
+profiling_enabled = False  # Включается командой /profile on
+current_trace = contextvars.ContextVar("current_trace", default=None)
+profile_slowest = []   # Куча (время, номер, трасса) с самыми медленными обновлениями
+profile_stats = {}     # Имя участка -> {"count": ..., "total_ms": ..., "max_ms": ...}; "route:*" учитываются всегда
+profile_sampled = 0    # Количество профилированных обновлений
+
+def _record_profile_stat(name: str, elapsed_ms: float):
+    stats = profile_stats.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["count"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+@contextlib.contextmanager
+def profile_span(name: str):
+    """Замеряет участок ввода-вывода внутри текущей трассы (если обновление профилируется)"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        trace["spans"].append({
+            "name": name,
+            "start_ms": round((started - trace["_started"]) * 1000, 2),
+            "ms": round(elapsed_ms, 2),
+        })
+        _record_profile_stat(name, elapsed_ms)
+
+def profiled_io(name: str):
+    """Декоратор: замеряет вызов функции ввода-вывода как участок трассы"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if current_trace.get() is None:
+                    return await func(*args, **kwargs)
+                with profile_span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return func(*args, **kwargs)
+            with profile_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def profiled_handler(func):
+    """Декоратор обработчика: при включенном профилировании собирает трассу для доли обновлений"""
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        # Вложенные вызовы (например, start_command из button_handler) пишутся в уже открытую трассу
+        if not profiling_enabled or current_trace.get() is not None or random.random() >= PROFILE_SAMPLE_RATE:
+            return await func(update, context, *args, **kwargs)
+
+        global profile_sampled
+        started = time.perf_counter()
+        trace = {
+            "handler": func.__name__,
+            "update_id": getattr(update, "update_id", None),
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "spans": [],
+            "_started": started,
+        }
+        token = current_trace.set(trace)
+        try:
+            return await func(update, context, *args, **kwargs)
+        finally:
+            current_trace.reset(token)
+            total_ms = (time.perf_counter() - started) * 1000
+            del trace["_started"]
+            trace["total_ms"] = round(total_ms, 2)
+            profile_sampled += 1
+            _record_profile_stat(f"handler:{func.__name__}", total_ms)
+            entry = (total_ms, profile_sampled, trace)
+            if len(profile_slowest) < PROFILE_TOP_N:
+                heapq.heappush(profile_slowest, entry)
+            else:
+                heapq.heappushpop(profile_slowest, entry)
+    return wrapper
+
+def build_profile_report():
+    """Собирает сводную статистику и самые медленные трассы. Вызывается в цикле событий, пока их никто не меняет"""
+    stats = {
+        name: {**values, "avg_ms": round(values["total_ms"] / values["count"], 2), "total_ms": round(values["total_ms"], 2), "max_ms": round(values["max_ms"], 2)}
+        for name, values in sorted(profile_stats.items(), key=lambda item: -item[1]["total_ms"])
+    }
+    report = {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "sampled_updates": profile_sampled,
+        "stats": stats,
+        # Копия списка участков: фоновая задача, унаследовавшая трассу, может дописать в него и после обработчика
+        "slowest": [{**trace, "spans": list(trace["spans"])} for _, _, trace in sorted(profile_slowest, key=lambda entry: -entry[0])],
+    }
+    return report
+
+def write_profile_report(report):
+    """Сохраняет собранный отчет в локальный файл"""
+    with open(PROFILE_OUTPUT_FILE, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
 
-# --- Глобальные переменные для аутентификации ---
-authenticated_users = set()  # Множество ID пользователей, прошедших аутентификацию
+# Как у запросов, которые ApplicationBuilder создает по умолчанию (у HTTPXRequest() - всего 1)
+TELEGRAM_CONNECTION_POOL_SIZE = 256
+
+class ProfiledRequest(HTTPXRequest):
+    """Запросы к Telegram API, которые попадают в трассу как отдельные участки"""
+    async def do_request(self, url, method, *args, **kwargs):
+        if current_trace.get() is None:
+            return await super().do_request(url, method, *args, **kwargs)
+        with profile_span(f"telegram:{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, *args, **kwargs)
 
 # --- Проверка конфигурации ---
 def check_configuration():
@@ -32,31 +176,145 @@ def check_configuration():
     
     if not os.path.exists(MENU_DATA_FILE):
         errors.append(f"❌ Не найден файл меню: {MENU_DATA_FILE}")
+    else:
+        try:
+            menu_errors, menu_warnings = validate_menu(read_menu_file())
+            errors += [f"❌ Меню: {error}" for error in menu_errors]
+            for warning in menu_warnings:
+                print(f"⚠️ Меню: {warning}")
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            errors.append(f"❌ Файл меню {MENU_DATA_FILE} не является корректным JSON: {e}")
     
     return errors
 
+# --- Сессии пользователей: аутентификация и состояние диалога ---
+SESSIONS_FILE = os.getenv("SESSIONS_FILE", "sessions.json")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(7 * 24 * 3600)))  # Срок жизни неактивной сессии
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "1000"))  # Сверх лимита вытесняются самые давние
+SESSION_SAVE_INTERVAL = 60  # Как часто (в секундах) сохранять обновленное время активности
+
+# ID пользователя -> {"auth": ..., "state": ..., "seen": ...}; порядок - от давно неактивных к недавним
+sessions = collections.OrderedDict()
+sessions_saved_at = 0.0
+
+def pin_fingerprint():
+    """Отпечаток текущего пин-кода для файла сессий (сам пин-код в файл не пишется)"""
+    return hmac.new((BOT_TOKEN or "").encode("utf-8"), ADMIN_PIN.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def load_sessions():
+    """Загружает сессии из файла, пропуская истекшие. Если пин-код сменился, вход сбрасывается"""
+    if not os.path.exists(SESSIONS_FILE):
+        return
+    now = time.time()
+    loaded = []
+    try:
+        with open(SESSIONS_FILE, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        # Файл старого формата без отпечатка считаем выданным под другой пин-код
+        pin_matches = isinstance(stored.get("pin"), str) and hmac.compare_digest(stored["pin"], pin_fingerprint())
+        # Файл хранит компактные записи [аутентифицирован, состояние, время активности]
+        for user_id, (auth, state, seen) in stored["sessions"].items():
+            if now - float(seen) < SESSION_TTL_SECONDS:
+                loaded.append((int(user_id), {"auth": bool(auth) and pin_matches, "state": state, "seen": float(seen)}))
+    except Exception as e:
+        print(f"⚠️ Ошибка чтения сессий из {SESSIONS_FILE}: {e}. Потребуется повторный вход.")
+        return
+
+    for user_id, session in sorted(loaded, key=lambda item: item[1]["seen"]):
+        sessions[user_id] = session
+    if not pin_matches:
+        print("⚠️ Пин-код изменился с момента сохранения сессий. Потребуется повторный вход.")
+    print(f"✅ Загружено сессий: {len(sessions)}")
+
+def save_sessions(force: bool = True):
+    """Атомарно сохраняет сессии. Без force - не чаще, чем раз в SESSION_SAVE_INTERVAL"""
+    global sessions_saved_at
+    now = time.time()
+    if not force and now - sessions_saved_at < SESSION_SAVE_INTERVAL:
+        return
+    stored = {
+        "pin": pin_fingerprint(),
+        "sessions": {
+            str(user_id): [int(session["auth"]), session["state"], int(session["seen"])]
+            for user_id, session in sessions.items()
+        },
+    }
+    try:
+        temp_file = SESSIONS_FILE + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write(serialize_compact(stored))
+        os.replace(temp_file, SESSIONS_FILE)
+        sessions_saved_at = now
+    except Exception as e:
+        print(f"⚠️ Ошибка сохранения сессий: {e}")
+
+def _evict_sessions(now: float):
+    # Самые давние сессии в начале, поэтому проверяем только их
+    while sessions:
+        user_id, session = next(iter(sessions.items()))
+        if now - session["seen"] < SESSION_TTL_SECONDS and len(sessions) <= SESSION_MAX_ENTRIES:
+            break
+        sessions.popitem(last=False)
+
+def get_session(user_id: int, create: bool = False):
+    """Возвращает активную сессию пользователя и продлевает ее"""
+    now = time.time()
+    session = sessions.get(user_id)
+    if session is not None and now - session["seen"] >= SESSION_TTL_SECONDS:
+        del sessions[user_id]
+        session = None
+    if session is None:
+        if not create:
+            return None
+        session = {"auth": False, "state": None, "seen": now}
+        sessions[user_id] = session
+        _evict_sessions(now)
+        return session
+
+    session["seen"] = now
+    sessions.move_to_end(user_id)
+    save_sessions(force=False)
+    return session
+
+def get_session_state(user_id: int):
+    session = get_session(user_id)
+    return session["state"] if session else None
+
+def set_session_state(user_id: int, state):
+    """Устанавливает (или сбрасывает при None) ожидаемый от пользователя ввод"""
+    session = get_session(user_id, create=state is not None)
+    if session is not None and session["state"] != state:
+        session["state"] = state
+        save_sessions()
+
+async def persist_sessions(application):
+    save_sessions()
+
 # --- Функция для проверки аутентификации пользователя ---
 async def is_authenticated(user_id: int) -> bool:
-    return user_id in authenticated_users
+    session = get_session(user_id)
+    return bool(session and session["auth"])
 
 # --- Обработчик ввода пин-кода ---
+@profiled_handler
 async def handle_pin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     entered_pin = update.message.text.strip()
     
     if entered_pin == ADMIN_PIN:
-        authenticated_users.add(user_id)
+        get_session(user_id, create=True)["auth"] = True
+        save_sessions()
         await update.message.reply_text(
             "✅ Успешная аутентификация!\n\nТеперь вы можете управлять меню и доставкой.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Открыть меню управления", callback_data="back_to_main")]
+                [InlineKeyboardButton("Открыть меню управления", callback_data=encode_callback("back_to_main"))]
             ])
         )
     else:
         await update.message.reply_text(
             "❌ Неверный пин-код. Попробуйте еще раз или обратитесь к администратору.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Попробовать снова", callback_data="request_pin")]
+                [InlineKeyboardButton("Попробовать снова", callback_data=encode_callback("request_pin"))]
             ])
         )
 
@@ -75,18 +333,245 @@ async def request_pin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 # --- Загрузка данных из JSON-файлов ---
-def load_menu_data():
+@profiled_io("file:menu_data")
+def read_menu_file():
     if os.path.exists(MENU_DATA_FILE):
         with open(MENU_DATA_FILE, 'r', encoding='utf-8') as f:
             return json.load(f)
     return {}
 
+def load_menu_data():
+    """Возвращает меню из кэша (при первом обращении читает файл)"""
+    if menu_state["data"] is None:
+        apply_menu(read_menu_file())
+    return menu_state["data"]
+
+def load_menu_state():
+    """Возвращает текущий кэш меню целиком. Обработчик берет его один раз и не перечитывает после await"""
+    load_menu_data()
+    return menu_state
+
+# --- Кэш меню: индексы и готовые кнопки по категориям ---
+menu_state = {
+    "data": None,                 # Меню в формате menu_data.json
+    "dish_index": {},             # ID блюда -> (ключ категории, блюдо)
+    "category_buttons": {},       # Ключ категории -> [(ID, название, цена, callback_data)]
+    "categories_keyboard": None,  # Клавиатура выбора категории
+}
+
+def validate_menu(data):
+    """Проверяет структуру меню и уникальность ID. Возвращает (ошибки, предупреждения)"""
+    errors = []
+    warnings = []
+    if not isinstance(data, dict):
+        return ["Меню должно быть JSON-объектом вида {\"категория\": [блюда]}"], warnings
+
+    seen_ids = {}
+    for category_key, dishes in data.items():
+        if category_key not in category_map:
+            warnings.append(f"Категория '{category_key}' отсутствует в category_map и не будет показана в боте")
+        if not isinstance(dishes, list):
+            errors.append(f"Категория '{category_key}': ожидается список блюд")
+            continue
+
+        seen_names = set()
+        for position, dish in enumerate(dishes, start=1):
+            where = f"Категория '{category_key}', блюдо №{position}"
+            if not isinstance(dish, dict):
+                errors.append(f"{where}: ожидается объект")
+                continue
+            dish_id = dish.get("id")
+            if not isinstance(dish_id, int) or isinstance(dish_id, bool):
+                errors.append(f"{where}: поле 'id' должно быть целым числом")
+            elif dish_id in seen_ids:
+                errors.append(f"{where}: ID {dish_id} уже используется в категории '{seen_ids[dish_id]}'")
+            else:
+                seen_ids[dish_id] = category_key
+            name = dish.get("name")
+            if not isinstance(name, str) or not name.strip():
+                errors.append(f"{where}: поле 'name' должно быть непустой строкой")
+            elif name in seen_names:
+                warnings.append(f"Категория '{category_key}': название '{name}' встречается несколько раз")
+            else:
+                seen_names.add(name)
+            price = dish.get("price")
+            if not isinstance(price, (int, float)) or isinstance(price, bool) or price < 0:
+                errors.append(f"{where}: поле 'price' должно быть неотрицательным числом")
+
+        # Ключ категории попадает в callback_data кнопок, поэтому должен кодироваться
+        try:
+            encode_callback("cat_stop", category_key)
+            encode_callback("disable_cat", category_key)
+            for dish in dishes:
+                if isinstance(dish, dict) and isinstance(dish.get("id"), int) and not isinstance(dish.get("id"), bool):
+                    encode_callback("dish_add", dish["id"], category_key)
+        except ValueError as e:
+            errors.append(f"Категория '{category_key}': ключ не подходит для кнопок Telegram ({e})")
+
+    return errors, warnings
+
+def diff_menu(old_data, new_data):
+    """Сравнивает меню по категориям. Возвращает только изменившиеся категории"""
+    diff = {}
+    for category_key in old_data.keys() | new_data.keys():
+        old_dishes = {dish['id']: dish for dish in old_data.get(category_key, [])}
+        new_dishes = {dish['id']: dish for dish in new_data.get(category_key, [])}
+        changes = {
+            "added": [dish_id for dish_id in new_dishes if dish_id not in old_dishes],
+            "removed": [dish_id for dish_id in old_dishes if dish_id not in new_dishes],
+            "changed": [dish_id for dish_id in new_dishes if dish_id in old_dishes and new_dishes[dish_id] != old_dishes[dish_id]],
+        }
+        # Порядок блюд влияет на клавиатуру, поэтому тоже считается изменением
+        if any(changes.values()) or list(old_dishes) != list(new_dishes):
+            diff[category_key] = changes
+    return diff
+
+def _build_category_buttons(category_key, dishes):
+    return [
+        (dish['id'], dish['name'], dish['price'], encode_callback("dish_add", dish['id'], category_key))
+        for dish in dishes
+    ]
+
+def _build_categories_keyboard(data):
+    keyboard = []
+    for key, label in category_map.items():
+        if data.get(key):
+            keyboard.append([InlineKeyboardButton(label, callback_data=encode_callback("cat_stop", key))])
+    keyboard.append([InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_menu_state(new_data):
+    """Собирает новый кэш меню, пересобирая индексы только для изменившихся категорий. Возвращает (кэш, diff)"""
+    old_state = menu_state
+    old_data = old_state["data"] or {}
+    diff = diff_menu(old_data, new_data)
+
+    dish_index = dict(old_state["dish_index"])
+    category_buttons = {key: buttons for key, buttons in old_state["category_buttons"].items() if key not in diff}
+    for category_key in diff:
+        for dish in old_data.get(category_key, []):
+            dish_index.pop(dish['id'], None)
+    for category_key in diff:
+        if category_key in new_data:
+            for dish in new_data[category_key]:
+                dish_index[dish['id']] = (category_key, dish)
+            category_buttons[category_key] = _build_category_buttons(category_key, new_data[category_key])
+
+    categories_keyboard = old_state["categories_keyboard"]
+    if categories_keyboard is None or {key for key, dishes in old_data.items() if dishes} != {key for key, dishes in new_data.items() if dishes}:
+        categories_keyboard = _build_categories_keyboard(new_data)
+
+    new_state = {
+        "data": new_data,
+        "dish_index": dish_index,
+        "category_buttons": category_buttons,
+        "categories_keyboard": categories_keyboard,
+    }
+    return new_state, diff
+
+def swap_menu_state(new_state):
+    """Подменяет кэш меню одним присваиванием: обработчики видят либо старое, либо новое меню целиком"""
+    global menu_state
+    menu_state = new_state
+
+def apply_menu(new_data):
+    """Собирает и сразу подменяет кэш меню"""
+    new_state, diff = build_menu_state(new_data)
+    swap_menu_state(new_state)
+    return diff
+
+# --- Очередь неотправленных в Gist изменений (переживает перезапуск) ---
+GIST_OUTBOX_FILE = os.getenv("GIST_OUTBOX_FILE", "gist_outbox.json")
+OUTBOX_RETRY_SECONDS = int(os.getenv("OUTBOX_RETRY_SECONDS", "60"))
+
+# Изменения в порядке поступления: {"ts": ...}. Последняя запись дополнительно хранит
+# полный снимок состояния ("stop_list", "delivery_status"), более ранние им перекрыты.
+gist_outbox = []
+
+def load_outbox():
+    """Загружает очередь из файла при запуске бота"""
+    if os.path.exists(GIST_OUTBOX_FILE):
+        try:
+            with open(GIST_OUTBOX_FILE, "r", encoding="utf-8") as f:
+                gist_outbox[:] = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения очереди {GIST_OUTBOX_FILE}: {e}. Очередь будет пустой.")
+            gist_outbox.clear()
+    if gist_outbox:
+        print(f"⏳ В очереди на отправку в Gist: {len(gist_outbox)} изменений")
+
+def save_outbox(entries=None):
+    """Атомарно записывает очередь (или указанные записи) на диск"""
+    temp_file = GIST_OUTBOX_FILE + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(gist_outbox if entries is None else entries, f, ensure_ascii=False)
+    os.replace(temp_file, GIST_OUTBOX_FILE)
+
+def enqueue_gist_write(stop_list, delivery_status):
+    """Добавляет изменение в очередь отправки в Gist"""
+    # Предыдущий снимок больше не нужен - отправлен будет только последний
+    if gist_outbox:
+        gist_outbox[-1].pop("stop_list", None)
+        gist_outbox[-1].pop("delivery_status", None)
+    gist_outbox.append({
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "stop_list": stop_list,
+        "delivery_status": delivery_status,
+    })
+    # Ошибка записи очереди не должна мешать сохранению в локальные файлы
+    try:
+        save_outbox()
+    except Exception as e:
+        print(f"⚠️ Ошибка записи очереди {GIST_OUTBOX_FILE}: {e}. Изменение будет отправлено, но не переживет перезапуск.")
+    print(f"⏳ Изменение поставлено в очередь на отправку в Gist (в очереди: {len(gist_outbox)})")
+
+async def drain_outbox():
+    """Отправляет накопленные изменения в Gist. Возвращает True, если очередь пуста"""
+    if not gist_outbox:
+        return True
+
+    # Последний снимок содержит все изменения из очереди
+    pending = len(gist_outbox)
+    latest = gist_outbox[pending - 1]
+    try:
+        await save_status_to_gist(latest["stop_list"], latest["delivery_status"])
+    except Exception as e:
+        print(f"⚠️ Gist по-прежнему недоступен: {e}. В очереди: {len(gist_outbox)}")
+        return False
+
+    # Сначала записываем на диск укороченную очередь и только потом убираем отправленное из памяти:
+    # иначе после перезапуска устаревший снимок из файла перезаписал бы более новый Gist.
+    # Записи, добавленные во время отправки, остаются в очереди до следующего прохода
+    try:
+        save_outbox(gist_outbox[pending:])
+    except Exception as e:
+        print(f"⚠️ Ошибка записи очереди {GIST_OUTBOX_FILE}: {e}. Повторим при следующем проходе.")
+        return False
+    del gist_outbox[:pending]
+    print(f"✅ Отправлено в Gist изменений из очереди: {pending} (осталось: {len(gist_outbox)})")
+    return not gist_outbox
+
+async def outbox_drainer():
+    """Фоновая задача: периодически пытается отправить очередь в Gist"""
+    while True:
+        if gist_outbox:
+            try:
+                await drain_outbox()
+            except Exception as e:
+                # Задача должна пережить любую ошибку, иначе очередь больше не будет отправляться
+                print(f"⚠️ Ошибка отправки очереди в Gist: {e}")
+        await asyncio.sleep(OUTBOX_RETRY_SECONDS)
+
+async def start_outbox_drainer(application):
+    application.create_task(outbox_drainer())
+
 async def load_status_from_gist_or_local():
     """Загружает текущий статус из Gist или из локальных файлов при ошибке"""
     stop_list = []
     delivery_status = {"disabled_until": None}
     
-    if GITHUB_TOKEN and GIST_ID:
+    # Пока очередь не отправлена, локальные файлы новее Gist - читаем их
+    if GITHUB_TOKEN and GIST_ID and not gist_outbox:
         try:
             stop_list, delivery_status = await load_status_from_gist()
             print("✅ Статус успешно загружен из Gist")
@@ -94,15 +579,25 @@ async def load_status_from_gist_or_local():
         except Exception as e:
             print(f"⚠️ Ошибка загрузки из Gist: {e}. Используем локальные файлы.")
     
+    # В режиме SQLite локальной копией служит база, а не JSON-файлы
+    if STORAGE_BACKEND == "sqlite":
+        try:
+            stop_list, delivery_status = await load_status_from_sqlite()
+            print("✅ Статус загружен из SQLite")
+        except Exception as e:
+            print(f"⚠️ Ошибка загрузки из SQLite: {e}. Используем значения по умолчанию.")
+        return stop_list, delivery_status
+    
     # Загрузка из локальных файлов как резервный вариант
     try:
-        if os.path.exists("stop_list.json"):
-            with open("stop_list.json", "r", encoding="utf-8") as f:
-                stop_list = json.load(f)
-                
-        if os.path.exists("delivery_status.json"):
-            with open("delivery_status.json", "r", encoding="utf-8") as f:
-                delivery_status = json.load(f)
+        with profile_span("file:load_status"):
+            if os.path.exists("stop_list.json"):
+                with open("stop_list.json", "r", encoding="utf-8") as f:
+                    stop_list = json.load(f)
+                    
+            if os.path.exists("delivery_status.json"):
+                with open("delivery_status.json", "r", encoding="utf-8") as f:
+                    delivery_status = json.load(f)
                 
         print("✅ Статус загружен из локальных файлов")
     except Exception as e:
@@ -110,6 +605,7 @@ async def load_status_from_gist_or_local():
     
     return stop_list, delivery_status
 
+@profiled_io("gist:load")
 async def load_status_from_gist():
     """Загружает текущий статус из GitHub Gist"""
     headers = {
@@ -128,33 +624,60 @@ async def load_status_from_gist():
                 stop_list = json.loads(files.get('stop_list.json', {}).get('content', '[]'))
                 delivery_status = json.loads(files.get('delivery_status.json', {}).get('content', '{"disabled_until": null}'))
                 
+                # Запоминаем состояние Gist, чтобы при сохранении отправлять только изменения
+                last_persisted_files["stop_list.json"] = serialize_compact(stop_list)
+                last_persisted_files["delivery_status.json"] = serialize_compact(delivery_status)
+                
                 return stop_list, delivery_status
             else:
                 error_text = await response.text()
                 raise Exception(f"Ошибка загрузки Gist: {response.status}, {error_text}")
 
-async def save_status_to_gist_or_local(stop_list, delivery_status):
+def serialize_compact(data):
+    """Сериализует данные в компактный JSON без лишних пробелов"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+async def save_status_to_gist_or_local(stop_list, delivery_status, user_id=None):
     """Сохраняет статус в Gist или в локальные файлы при ошибке"""
+    # В режиме SQLite база обновляется при каждом сохранении, чтобы журнал изменений был полным
+    sqlite_saved = False
+    if STORAGE_BACKEND == "sqlite":
+        try:
+            sqlite_saved = await save_status_to_sqlite(stop_list, delivery_status, user_id)
+        except Exception as e:
+            print(f"❌ Ошибка сохранения в SQLite: {e}")
+    
     success = False
     
-    if GITHUB_TOKEN and GIST_ID:
+    if GITHUB_TOKEN and GIST_ID and gist_outbox:
+        # Более ранние изменения еще не отправлены - сохраняем порядок через очередь
+        enqueue_gist_write(stop_list, delivery_status)
+    elif GITHUB_TOKEN and GIST_ID:
         try:
             success = await save_status_to_gist(stop_list, delivery_status)
             if success:
-                print("✅ Статус успешно сохранен в Gist")
+                print(f"✅ Статус успешно сохранен в Gist ({format_gist_save_stats()})")
                 return True
             else:
                 print("⚠️ Не удалось сохранить статус в Gist. Попробуем локальные файлы.")
+                enqueue_gist_write(stop_list, delivery_status)
         except Exception as e:
             print(f"⚠️ Ошибка сохранения в Gist: {e}. Попробуем локальные файлы.")
+            enqueue_gist_write(stop_list, delivery_status)
+    
+    if STORAGE_BACKEND == "sqlite":
+        if sqlite_saved:
+            print("✅ Статус сохранен в SQLite")
+        return sqlite_saved
     
     # Сохранение в локальные файлы как резервный вариант
     try:
-        with open("stop_list.json", "w", encoding="utf-8") as f:
-            json.dump(stop_list, f, ensure_ascii=False, indent=2)
-        
-        with open("delivery_status.json", "w", encoding="utf-8") as f:
-            json.dump(delivery_status, f, ensure_ascii=False, indent=2)
+        with profile_span("file:save_status"):
+            with open("stop_list.json", "w", encoding="utf-8") as f:
+                json.dump(stop_list, f, ensure_ascii=False, indent=2)
+            
+            with open("delivery_status.json", "w", encoding="utf-8") as f:
+                json.dump(delivery_status, f, ensure_ascii=False, indent=2)
         
         print("✅ Статус сохранен в локальные файлы")
         return True
@@ -162,6 +685,21 @@ async def save_status_to_gist_or_local(stop_list, delivery_status):
         print(f"❌ Критическая ошибка: не удалось сохранить статус ни в Gist, ни в локальные файлы: {e}")
         return False
 
+def full_gist_payload_size(stop_list, delivery_status):
+    """Размер полной отправки в старом формате (оба файла с отступами) - для статистики"""
+    return len(json.dumps({"files": {
+        "stop_list.json": {"content": json.dumps(stop_list, ensure_ascii=False, indent=2)},
+        "delivery_status.json": {"content": json.dumps(delivery_status, ensure_ascii=False, indent=2)}
+    }}).encode("utf-8"))
+
+def format_gist_save_stats():
+    return (
+        f"запросов: {gist_save_stats['requests_sent']}, "
+        f"пропущено: {gist_save_stats['requests_suppressed']}, "
+        f"сэкономлено: {gist_save_stats['bytes_saved']} байт"
+    )
+
+@profiled_io("gist:save")
 async def save_status_to_gist(stop_list, delivery_status):
     """Сохраняет статус в GitHub Gist"""
     headers = {
@@ -171,16 +709,33 @@ async def save_status_to_gist(stop_list, delivery_status):
     }
     url = f"https://api.github.com/gists/{GIST_ID}"
     
+    new_contents = {
+        "stop_list.json": serialize_compact(stop_list),
+        "delivery_status.json": serialize_compact(delivery_status)
+    }
+    
+    # Отправляем только файлы, содержимое которых отличается от сохраненного ранее
     files = {
-        "stop_list.json": {"content": json.dumps(stop_list, ensure_ascii=False, indent=2)},
-        "delivery_status.json": {"content": json.dumps(delivery_status, ensure_ascii=False, indent=2)}
+        name: {"content": content}
+        for name, content in new_contents.items()
+        if last_persisted_files.get(name) != content
     }
     
+    if not files:
+        # Ничего не изменилось - запрос не нужен
+        gist_save_stats["requests_suppressed"] += 1
+        gist_save_stats["bytes_saved"] += full_gist_payload_size(stop_list, delivery_status)
+        print(f"ℹ️ Статус не изменился, сохранение в Gist пропущено ({format_gist_save_stats()})")
+        return True
+    
     payload = {"files": files}
     
     async with aiohttp.ClientSession() as session:
         async with session.patch(url, json=payload, headers=headers, timeout=10) as response:
             if response.status == 200:
+                last_persisted_files.update({name: file["content"] for name, file in files.items()})
+                gist_save_stats["requests_sent"] += 1
+                gist_save_stats["bytes_saved"] += full_gist_payload_size(stop_list, delivery_status) - len(json.dumps(payload).encode("utf-8"))
                 return True
             else:
                 error_text = await response.text()
@@ -279,6 +834,191 @@ async def create_or_repair_gist():
                 print(f"❌ Ошибка создания Gist: {response.status}, {error_text}")
                 return None
 
+# --- Хранилище SQLite (опционально, STORAGE_BACKEND=sqlite) ---
+sqlite_schema_ready = False
+
+def sqlite_connect():
+    """Открывает соединение с базой SQLite и при первом вызове создает схему"""
+    global sqlite_schema_ready
+    conn = sqlite3.connect(SQLITE_DB_FILE, timeout=10)
+    if not sqlite_schema_ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts TEXT NOT NULL,
+                user_id INTEGER,
+                action TEXT NOT NULL,
+                dish_id INTEGER,
+                value TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts);
+            CREATE INDEX IF NOT EXISTS idx_events_dish_ts ON events (dish_id, ts);
+        """)
+        sqlite_schema_ready = True
+    return conn
+
+def _sqlite_has_state_sync():
+    conn = sqlite_connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM state").fetchone()[0] > 0
+    finally:
+        conn.close()
+
+def _seed_sqlite_sync(stop_list, delivery_status):
+    conn = sqlite_connect()
+    try:
+        with conn:
+            if conn.execute("SELECT COUNT(*) FROM state").fetchone()[0] > 0:
+                return
+            conn.executemany("INSERT INTO state (key, value) VALUES (?, ?)", [
+                ("stop_list", serialize_compact(stop_list)),
+                ("delivery_status", serialize_compact(delivery_status)),
+            ])
+            # Открывающие события для начального состояния (без пользователя), иначе
+            # последующие stop_remove не с чем сопоставить в /history и /report
+            ts = datetime.now().isoformat(timespec="seconds")
+            events = [(ts, None, "stop_add", dish_id, None) for dish_id in stop_list]
+            if delivery_status.get("disabled_until"):
+                events.append((ts, None, "delivery_off", None, delivery_status["disabled_until"]))
+            conn.executemany(
+                "INSERT INTO events (ts, user_id, action, dish_id, value) VALUES (?, ?, ?, ?, ?)",
+                events
+            )
+    finally:
+        conn.close()
+
+async def init_sqlite_storage():
+    """При первом запуске заполняет базу текущим статусом: из Gist, а при ошибке - из локальных файлов"""
+    if await asyncio.to_thread(_sqlite_has_state_sync):
+        return
+
+    # Локальные файлы в режиме Gist обновляются только при ошибках сохранения и обычно устарели,
+    # если только в очереди нет неотправленных изменений
+    if GITHUB_TOKEN and GIST_ID and not gist_outbox:
+        try:
+            stop_list, delivery_status = await load_status_from_gist()
+            await asyncio.to_thread(_seed_sqlite_sync, stop_list, delivery_status)
+            print("✅ База SQLite создана из Gist")
+            return
+        except Exception as e:
+            print(f"⚠️ Ошибка загрузки из Gist: {e}. База SQLite будет создана из локальных файлов.")
+
+    stop_list = []
+    delivery_status = {"disabled_until": None}
+    if os.path.exists("stop_list.json"):
+        with open("stop_list.json", "r", encoding="utf-8") as f:
+            stop_list = json.load(f)
+    if os.path.exists("delivery_status.json"):
+        with open("delivery_status.json", "r", encoding="utf-8") as f:
+            delivery_status = json.load(f)
+    await asyncio.to_thread(_seed_sqlite_sync, stop_list, delivery_status)
+    print("✅ База SQLite создана из локальных файлов")
+
+def _read_state(conn):
+    state = dict(conn.execute("SELECT key, value FROM state").fetchall())
+    stop_list = json.loads(state.get("stop_list", "[]"))
+    delivery_status = json.loads(state.get("delivery_status", '{"disabled_until": null}'))
+    return stop_list, delivery_status
+
+def _load_status_sqlite_sync():
+    conn = sqlite_connect()
+    try:
+        return _read_state(conn)
+    finally:
+        conn.close()
+
+def _save_status_sqlite_sync(stop_list, delivery_status, user_id):
+    conn = sqlite_connect()
+    try:
+        with conn:
+            old_stop_list, old_delivery_status = _read_state(conn)
+            ts = datetime.now().isoformat(timespec="seconds")
+
+            # Каждое изменение записываем отдельным событием
+            events = []
+            old_ids = set(old_stop_list)
+            new_ids = set(stop_list)
+            events += [(ts, user_id, "stop_add", dish_id, None) for dish_id in stop_list if dish_id not in old_ids]
+            events += [(ts, user_id, "stop_remove", dish_id, None) for dish_id in old_stop_list if dish_id not in new_ids]
+            if delivery_status.get("disabled_until") != old_delivery_status.get("disabled_until"):
+                if delivery_status.get("disabled_until"):
+                    events.append((ts, user_id, "delivery_off", None, delivery_status["disabled_until"]))
+                else:
+                    events.append((ts, user_id, "delivery_on", None, None))
+
+            conn.executemany(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                [("stop_list", serialize_compact(stop_list)), ("delivery_status", serialize_compact(delivery_status))]
+            )
+            conn.executemany(
+                "INSERT INTO events (ts, user_id, action, dish_id, value) VALUES (?, ?, ?, ?, ?)",
+                events
+            )
+        return True
+    finally:
+        conn.close()
+
+@profiled_io("sqlite:load")
+async def load_status_from_sqlite():
+    """Загружает текущий статус из базы SQLite"""
+    return await asyncio.to_thread(_load_status_sqlite_sync)
+
+@profiled_io("sqlite:save")
+async def save_status_to_sqlite(stop_list, delivery_status, user_id=None):
+    """Сохраняет статус в базу SQLite и записывает изменения в журнал событий"""
+    return await asyncio.to_thread(_save_status_sqlite_sync, stop_list, delivery_status, user_id)
+
+def _query_history_sync(start, end, dish_id=None, limit=50):
+    """Возвращает события за период и (для блюда) суммарное время в стоп-листе в секундах"""
+    conn = sqlite_connect()
+    try:
+        start_ts = start.isoformat(timespec="seconds")
+        end_ts = end.isoformat(timespec="seconds")
+        if dish_id is None:
+            rows = conn.execute(
+                "SELECT ts, user_id, action, dish_id, value FROM events "
+                "WHERE ts >= ? AND ts <= ? ORDER BY ts DESC, id DESC LIMIT ?",
+                (start_ts, end_ts, limit)
+            ).fetchall()
+            return rows, None
+
+        rows = conn.execute(
+            "SELECT ts, user_id, action, dish_id, value FROM events "
+            "WHERE dish_id = ? AND ts >= ? AND ts <= ? ORDER BY ts, id",
+            (dish_id, start_ts, end_ts)
+        ).fetchall()
+
+        # Состояние блюда на начало периода - по последнему событию до него
+        previous = conn.execute(
+            "SELECT action FROM events WHERE dish_id = ? AND ts < ? ORDER BY ts DESC, id DESC LIMIT 1",
+            (dish_id, start_ts)
+        ).fetchone()
+        stopped_since = start if previous and previous[0] == "stop_add" else None
+
+        unavailable = 0.0
+        for ts, _, action, _, _ in rows:
+            moment = datetime.fromisoformat(ts)
+            if action == "stop_add" and stopped_since is None:
+                stopped_since = moment
+            elif action == "stop_remove" and stopped_since is not None:
+                unavailable += (moment - stopped_since).total_seconds()
+                stopped_since = None
+        if stopped_since is not None:
+            unavailable += (min(end, datetime.now()) - stopped_since).total_seconds()
+
+        return rows[::-1][:limit], unavailable
+    finally:
+        conn.close()
+
+async def query_history(start, end, dish_id=None, limit=50):
+    """Выполняет запрос к журналу событий вне цикла событий"""
+    return await asyncio.to_thread(_query_history_sync, start, end, dish_id, limit)
+
 # --- Вспомогательные функции ---
 async def is_delivery_disabled():
     _, delivery_status = await load_status_from_gist_or_local()
@@ -288,6 +1028,7 @@ async def is_delivery_disabled():
     return False
 
 # --- Обработчики команд и кнопок ---
+@profiled_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -308,9 +1049,9 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     delivery_button_text = "Включить доставку" if delivery_disabled else "Выключить доставку"
 
     keyboard = [
-        [InlineKeyboardButton("Добавить в стоп-лист", callback_data="add_to_stop")],
-        [InlineKeyboardButton(delivery_button_text, callback_data="toggle_delivery")],
-        [InlineKeyboardButton("Убрать из стоп-листа", callback_data="remove_from_stop")],
+        [InlineKeyboardButton("Добавить в стоп-лист", callback_data=encode_callback("add_to_stop"))],
+        [InlineKeyboardButton(delivery_button_text, callback_data=encode_callback("toggle_delivery"))],
+        [InlineKeyboardButton("Убрать из стоп-листа", callback_data=encode_callback("remove_from_stop"))],
        
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -320,6 +1061,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         _, delivery_status = await load_status_from_gist_or_local()
         disabled_until = datetime.fromisoformat(delivery_status["disabled_until"])
         message_text += f"\n\n🔴 Доставка временно отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}."
+    if gist_outbox:
+        message_text += f"\n\n⏳ Изменений ждут отправки в Gist: {len(gist_outbox)}"
 
     if query:
         await query.edit_message_text(text=message_text, reply_markup=reply_markup)
@@ -327,15 +1070,91 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(text=message_text, reply_markup=reply_markup)
 
 
-async def get_category_from_dish_id(dish_id: int, menu_data: dict) -> str:
+async def get_category_from_dish_id(dish_id: int, menu) -> str:
     """Находит категорию по ID блюда"""
-    for category, dishes in menu_data.items():
-        for dish in dishes:
-            if dish['id'] == dish_id:
-                return category
-    return ""
+    entry = menu["dish_index"].get(dish_id)
+    return entry[0] if entry else ""
+
+
+# --- Маршрутизация callback-запросов ---
+# Формат callback_data: "<версия><код действия>|<арг1>|<арг2>..."
+# Числа кодируются в base36, чтобы данные укладывались в лимит Telegram (64 байта).
+CALLBACK_VERSION = "1"
+CALLBACK_MAX_BYTES = 64
+CALLBACK_SEPARATOR = "|"
+
+callback_routes = {}   # Код действия -> (имя действия, обработчик, типы аргументов)
+callback_codes = {}    # Имя действия -> код действия
+
+
+def callback_action(name: str, code: str, *arg_types):
+    """Регистрирует обработчик callback-действия с типизированными аргументами"""
+    def decorator(handler):
+        if code in callback_routes:
+            raise ValueError(f"Код действия '{code}' уже занят действием '{callback_routes[code][0]}'")
+        callback_routes[code] = (name, handler, arg_types)
+        callback_codes[name] = code
+        return handler
+    return decorator
+
+
+def _int_to_base36(value: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    if value < 0:
+        return "-" + _int_to_base36(-value)
+    result = ""
+    while True:
+        value, remainder = divmod(value, 36)
+        result = digits[remainder] + result
+        if value == 0:
+            return result
+
+
+def encode_callback(name: str, *args) -> str:
+    """Кодирует действие и его аргументы в компактную строку callback_data"""
+    code = callback_codes[name]
+    _, _, arg_types = callback_routes[code]
+    if len(args) != len(arg_types):
+        raise ValueError(f"Действие '{name}' ожидает {len(arg_types)} аргумент(ов), получено {len(args)}")
+
+    parts = [CALLBACK_VERSION + code]
+    for arg, arg_type in zip(args, arg_types):
+        if arg_type is int:
+            parts.append(_int_to_base36(int(arg)))
+        else:
+            arg = str(arg)
+            if CALLBACK_SEPARATOR in arg:
+                raise ValueError(f"Аргумент '{arg}' содержит недопустимый символ '{CALLBACK_SEPARATOR}'")
+            parts.append(arg)
+
+    data = CALLBACK_SEPARATOR.join(parts)
+    if len(data.encode("utf-8")) > CALLBACK_MAX_BYTES:
+        raise ValueError(f"callback_data для действия '{name}' превышает {CALLBACK_MAX_BYTES} байт: {data}")
+    return data
+
 
+def decode_callback(data: str):
+    """Декодирует callback_data. Возвращает (код действия, аргументы) или None, если данные некорректны"""
+    if not data or not data.startswith(CALLBACK_VERSION):
+        return None
 
+    code, *raw_args = data[len(CALLBACK_VERSION):].split(CALLBACK_SEPARATOR)
+    route = callback_routes.get(code)
+    if route is None:
+        return None
+
+    _, _, arg_types = route
+    if len(raw_args) != len(arg_types):
+        return None
+
+    try:
+        args = [int(raw, 36) if arg_type is int else raw for raw, arg_type in zip(raw_args, arg_types)]
+    except ValueError:
+        return None
+    return code, args
+
+
+@profiled_handler
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -348,329 +1167,339 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    data = query.data
-    menu_data = load_menu_data()
-    stop_list, _ = await load_status_from_gist_or_local()
-
-    # Обработка изменения пин-кода
-    if data == "change_pin":
-        await query.edit_message_text(
-            "🔑 Введите новый пин-код (4-6 цифр):",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("<< Назад", callback_data="back_to_main")]
-            ])
-        )
-        context.user_data['awaiting_new_pin'] = True
+    decoded = decode_callback(query.data)
+    if decoded is None:
+        # Устаревшая или поврежденная кнопка - возвращаем в главное меню
+        print(f"⚠️ Неизвестные callback_data: {query.data}")
+        await start_command(update, context)
         return
 
+    code, args = decoded
+    name, handler, _ = callback_routes[code]
+
     # Если пользователь вводит новый пин-код
-    if context.user_data.get('awaiting_new_pin') and data != "back_to_main":
+    if get_session_state(user_id) == "new_pin" and name != "back_to_main":
         # Игнорируем, так как ожидаем текстовое сообщение
         return
 
-    # Главное меню - добавление в стоп-лист
-    if data == "add_to_stop":
-        keyboard = []
-        for key, label in category_map.items():
-            if menu_data.get(key):
-                keyboard.append([InlineKeyboardButton(label, callback_data=f"cat_stop_{key}")])
-        keyboard.append([InlineKeyboardButton("<< Назад", callback_data="back_to_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text="📂 Выберите категорию блюда для добавления в стоп-лист:", reply_markup=reply_markup)
+    started = time.perf_counter()
+    try:
+        await handler(update, context, *args)
+    finally:
+        # Время действий копится в общей статистике профилирования (/profile dump)
+        _record_profile_stat(f"route:{name}", (time.perf_counter() - started) * 1000)
 
-    # Выбор категории для добавления в стоп-лист
-    elif data.startswith("cat_stop_"):
-        category_key = data[9:]
-        category_label = category_map.get(category_key, "Неизвестная категория")
 
-        if not menu_data.get(category_key):
-            await query.edit_message_text(text=f"❌ В категории '{category_label}' нет блюд.")
-            return
+# --- Обработчики callback-действий ---
+@callback_action("request_pin", "p")
+async def on_request_pin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await request_pin(update, context)
 
-        keyboard = []
-        for dish in menu_data[category_key]:
-            dish_id = dish['id']
-            dish_name = dish['name']
-            # Используем крестик (❌) для блюд в стоп-листе
-            button_text = f"{dish_name} ❌" if dish_id in stop_list else dish_name
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"dish_add_{dish_id}_{category_key}")])
-
-        # Кнопка отключения всей категории
-        keyboard.append([InlineKeyboardButton(f"❌ Отключить все '{category_label}'", callback_data=f"disable_cat_{category_key}")])
-        keyboard.append([InlineKeyboardButton("<< Назад к категориям", callback_data="add_to_stop")])
-        keyboard.append([InlineKeyboardButton("<< Назад", callback_data="back_to_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text=f"🍱 Выберите блюдо из категории '{category_label}' для добавления в стоп-лист:", reply_markup=reply_markup)
-
-    # Добавление конкретного блюда в стоп-лист
-    elif data.startswith("dish_add_"):
-        # Извлекаем ID блюда и категорию из callback_data
-        parts = data.split('_')
-        dish_id_str = parts[2]
-        category_key = parts[3] if len(parts) > 3 else ""
-        
-        try:
-            dish_id = int(dish_id_str)
-        except ValueError:
-            await query.edit_message_text(text="❌ Ошибка: некорректный ID блюда.")
-            return
 
+@callback_action("change_pin", "cp")
+async def on_change_pin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(
+        "🔑 Введите новый пин-код (4-6 цифр):",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))]
+        ])
+    )
+    set_session_state(update.effective_user.id, "new_pin")
+
+
+# Главное меню - добавление в стоп-лист
+@callback_action("add_to_stop", "as")
+async def on_add_to_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    menu = load_menu_state()
+    reply_markup = menu["categories_keyboard"]
+    await query.edit_message_text(text="📂 Выберите категорию блюда для добавления в стоп-лист:", reply_markup=reply_markup)
+
+
+# Выбор категории для добавления в стоп-лист
+@callback_action("cat_stop", "cs", str)
+async def on_cat_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, category_key: str):
+    query = update.callback_query
+    menu = load_menu_state()
+    stop_list, _ = await load_status_from_gist_or_local()
+    category_label = category_map.get(category_key, "Неизвестная категория")
+
+    if not menu["data"].get(category_key):
+        await query.edit_message_text(text=f"❌ В категории '{category_label}' нет блюд.")
+        return
+
+    keyboard = []
+    for dish_id, dish_name, _, callback_data in menu["category_buttons"].get(category_key, []):
+        # Используем крестик (❌) для блюд в стоп-листе
+        button_text = f"{dish_name} ❌" if dish_id in stop_list else dish_name
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
+
+    # Кнопка отключения всей категории
+    keyboard.append([InlineKeyboardButton(f"❌ Отключить все '{category_label}'", callback_data=encode_callback("disable_cat", category_key))])
+    keyboard.append([InlineKeyboardButton("<< Назад к категориям", callback_data=encode_callback("add_to_stop"))])
+    keyboard.append([InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(text=f"🍱 Выберите блюдо из категории '{category_label}' для добавления в стоп-лист:", reply_markup=reply_markup)
+
+
+# Добавление конкретного блюда в стоп-лист
+@callback_action("dish_add", "da", int, str)
+async def on_dish_add(update: Update, context: ContextTypes.DEFAULT_TYPE, dish_id: int, category_key: str):
+    query = update.callback_query
+    menu = load_menu_state()
+
+    if not category_key:
+        # Если категория не указана, пытаемся найти ее
+        category_key = await get_category_from_dish_id(dish_id, menu)
         if not category_key:
-            # Если категория не указана, пытаемся найти ее
-            category_key = await get_category_from_dish_id(dish_id, menu_data)
-            if not category_key:
-                await query.edit_message_text(text="❌ Ошибка: не удалось определить категорию блюда.")
-                return
+            await query.edit_message_text(text="❌ Ошибка: не удалось определить категорию блюда.")
+            return
 
-        stop_list, delivery_status = await load_status_from_gist_or_local()
-        if dish_id not in stop_list:
-            stop_list.append(dish_id)
-            success = await save_status_to_gist_or_local(stop_list, delivery_status)
-            
-            dish_name = "Блюдо"
-            dish_price = 0
-            for dishes in menu_data.values():
-                for dish in dishes:
-                    if dish['id'] == dish_id:
-                        dish_name = dish['name']
-                        dish_price = dish['price']
-                        break
-                        
-            if success:
-                await query.edit_message_text(
-                    text=f"✅ Блюдо '{dish_name}' (ID: {dish_id}, {dish_price}₽) добавлено в стоп-лист!\n\nВыберите следующее действие:", 
-                    reply_markup=await get_category_keyboard(category_key, menu_data, stop_list)
-                )
-            else:
-                await query.edit_message_text(
-                    text=f"⚠️ Блюдо '{dish_name}' добавлено в стоп-лист, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:", 
-                    reply_markup=await get_category_keyboard(category_key, menu_data, stop_list)
-                )
+    stop_list, delivery_status = await load_status_from_gist_or_local()
+    if dish_id not in stop_list:
+        stop_list.append(dish_id)
+        success = await save_status_to_gist_or_local(stop_list, delivery_status, user_id=update.effective_user.id)
+        
+        dish_name = "Блюдо"
+        dish_price = 0
+        if dish_id in menu["dish_index"]:
+            _, dish = menu["dish_index"][dish_id]
+            dish_name = dish['name']
+            dish_price = dish['price']
+                    
+        if success:
+            await query.edit_message_text(
+                text=f"✅ Блюдо '{dish_name}' (ID: {dish_id}, {dish_price}₽) добавлено в стоп-лист!\n\nВыберите следующее действие:", 
+                reply_markup=await get_category_keyboard(category_key, menu, stop_list)
+            )
         else:
-            # Если блюдо уже в стоп-листе, просто обновляем клавиатуру
-            await query.edit_message_reply_markup(reply_markup=await get_category_keyboard(category_key, menu_data, stop_list))
-
-    # Отключение всех блюд в категории
-    elif data.startswith("disable_cat_"):
-        category_key = data[12:]
-        category_label = category_map.get(category_key, "Неизвестная категория")
-        dishes_in_cat = menu_data.get(category_key, [])
-        stop_list, delivery_status = await load_status_from_gist_or_local()
-        new_dish_ids = [dish['id'] for dish in dishes_in_cat if dish['id'] not in stop_list]
-        if new_dish_ids:
-            stop_list.extend(new_dish_ids)
-            success = await save_status_to_gist_or_local(stop_list, delivery_status)
-            
-            if success:
-                await query.edit_message_text(
-                    text=f"✅ Все блюда из категории '{category_label}' ({len(new_dish_ids)} шт.) добавлены в стоп-лист!\n\nВыберите следующее действие:", 
-                    reply_markup=await get_category_keyboard(category_key, menu_data, stop_list)
-                )
-            else:
-                await query.edit_message_text(
-                    text=f"⚠️ Все блюда из категории '{category_label}' добавлены в стоп-лист, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:", 
-                    reply_markup=await get_category_keyboard(category_key, menu_data, stop_list)
-                )
+            await query.edit_message_text(
+                text=f"⚠️ Блюдо '{dish_name}' добавлено в стоп-лист, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:", 
+                reply_markup=await get_category_keyboard(category_key, menu, stop_list)
+            )
+    else:
+        # Если блюдо уже в стоп-листе, просто обновляем клавиатуру
+        await query.edit_message_reply_markup(reply_markup=await get_category_keyboard(category_key, menu, stop_list))
+
+
+# Отключение всех блюд в категории
+@callback_action("disable_cat", "dc", str)
+async def on_disable_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, category_key: str):
+    query = update.callback_query
+    menu = load_menu_state()
+    category_label = category_map.get(category_key, "Неизвестная категория")
+    dishes_in_cat = menu["data"].get(category_key, [])
+    stop_list, delivery_status = await load_status_from_gist_or_local()
+    new_dish_ids = [dish['id'] for dish in dishes_in_cat if dish['id'] not in stop_list]
+    if new_dish_ids:
+        stop_list.extend(new_dish_ids)
+        success = await save_status_to_gist_or_local(stop_list, delivery_status, user_id=update.effective_user.id)
+        
+        if success:
+            await query.edit_message_text(
+                text=f"✅ Все блюда из категории '{category_label}' ({len(new_dish_ids)} шт.) добавлены в стоп-лист!\n\nВыберите следующее действие:", 
+                reply_markup=await get_category_keyboard(category_key, menu, stop_list)
+            )
         else:
-            await query.answer(f"ℹ️ Все блюда из категории '{category_label}' уже в стоп-листе.")
-            # Обновляем клавиатуру
-            await query.edit_message_reply_markup(reply_markup=await get_category_keyboard(category_key, menu_data, stop_list))
+            await query.edit_message_text(
+                text=f"⚠️ Все блюда из категории '{category_label}' добавлены в стоп-лист, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:", 
+                reply_markup=await get_category_keyboard(category_key, menu, stop_list)
+            )
+    else:
+        await query.answer(f"ℹ️ Все блюда из категории '{category_label}' уже в стоп-листе.")
+        # Обновляем клавиатуру
+        await query.edit_message_reply_markup(reply_markup=await get_category_keyboard(category_key, menu, stop_list))
+
+
+# --- Вспомогательная функция для получения клавиатуры удаления из стоп-листа ---
+def get_remove_keyboard(stop_list, menu):
+    keyboard = []
+    for dish_id in stop_list:
+        dish_name = f"Блюдо ID {dish_id}"
+        dish_price = 0
+        if dish_id in menu["dish_index"]:
+            _, dish = menu["dish_index"][dish_id]
+            dish_name = dish['name']
+            dish_price = dish['price']
+        # Отображаем имя блюда с крестиком в меню удаления
+        keyboard.append([InlineKeyboardButton(f"{dish_name} ({dish_price}₽) ❌", callback_data=encode_callback("dish_remove", dish_id))])
+
+    # Кнопка включения всех блюд
+    keyboard.append([InlineKeyboardButton("✅ Включить все блюда (очистить стоп-лист)", callback_data=encode_callback("enable_all_dishes"))])
+    keyboard.append([InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))])
+    return InlineKeyboardMarkup(keyboard)
 
 
-    # Меню удаления из стоп-листа
-    elif data == "remove_from_stop":
+# Меню удаления из стоп-листа
+@callback_action("remove_from_stop", "rs")
+async def on_remove_from_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    menu = load_menu_state()
+    stop_list, _ = await load_status_from_gist_or_local()
+    if not stop_list:
+        await query.edit_message_text(text="ostringstream Стоп-лист пуст.")
+        await start_command(update, context)
+        return
+
+    reply_markup = get_remove_keyboard(stop_list, menu)
+    await query.edit_message_text(text="🗑️ Выберите блюдо для удаления из стоп-листа:", reply_markup=reply_markup)
+
+
+# Удаление конкретного блюда из стоп-листа
+@callback_action("dish_remove", "dr", int)
+async def on_dish_remove(update: Update, context: ContextTypes.DEFAULT_TYPE, dish_id: int):
+    query = update.callback_query
+    menu = load_menu_state()
+    stop_list, delivery_status = await load_status_from_gist_or_local()
+    if dish_id in stop_list:
+        stop_list.remove(dish_id)
+        success = await save_status_to_gist_or_local(stop_list, delivery_status, user_id=update.effective_user.id)
+        
+        # После удаления обновляем список блюд в стоп-листе
         stop_list, _ = await load_status_from_gist_or_local()
         if not stop_list:
             await query.edit_message_text(text="ostringstream Стоп-лист пуст.")
             await start_command(update, context)
             return
-
-        keyboard = []
-        for dish_id in stop_list:
-            dish_name = f"Блюдо ID {dish_id}"
-            dish_price = 0
-            for dishes in menu_data.values():
-                for dish in dishes:
-                    if dish['id'] == dish_id:
-                        dish_name = dish['name']
-                        dish_price = dish['price']
-                        break
-            # Отображаем имя блюда с крестиком в меню удаления
-            keyboard.append([InlineKeyboardButton(f"{dish_name} ({dish_price}₽) ❌", callback_data=f"dish_remove_{dish_id}")])
-
-        # Кнопка включения всех блюд
-        keyboard.append([InlineKeyboardButton("✅ Включить все блюда (очистить стоп-лист)", callback_data="enable_all_dishes")])
-        keyboard.append([InlineKeyboardButton("<< Назад", callback_data="back_to_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text="🗑️ Выберите блюдо для удаления из стоп-листа:", reply_markup=reply_markup)
-
-    # Удаление конкретного блюда из стоп-листа
-    elif data.startswith("dish_remove_"):
-        dish_id_str = data[12:]
-        try:
-            dish_id = int(dish_id_str)
-        except ValueError:
-            await query.edit_message_text(text="❌ Ошибка: некорректный ID блюда.")
-            return
-
-        stop_list, delivery_status = await load_status_from_gist_or_local()
-        if dish_id in stop_list:
-            stop_list.remove(dish_id)
-            success = await save_status_to_gist_or_local(stop_list, delivery_status)
-            
-            # После удаления обновляем список блюд в стоп-листе
-            stop_list, _ = await load_status_from_gist_or_local()
-            if not stop_list:
-                await query.edit_message_text(text="ostringstream Стоп-лист пуст.")
-                await start_command(update, context)
-                return
-                
-            keyboard = []
-            for id in stop_list:
-                dish_name = f"Блюдо ID {id}"
-                dish_price = 0
-                for dishes in menu_data.values():
-                    for dish in dishes:
-                        if dish['id'] == id:
-                            dish_name = dish['name']
-                            dish_price = dish['price']
-                            break
-                keyboard.append([InlineKeyboardButton(f"{dish_name} ({dish_price}₽) ❌", callback_data=f"dish_remove_{id}")])
-
-            keyboard.append([InlineKeyboardButton("✅ Включить все блюда (очистить стоп-лист)", callback_data="enable_all_dishes")])
-            keyboard.append([InlineKeyboardButton("<< Назад", callback_data="back_to_main")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
             
-            if success:
-                await query.edit_message_text(text="🗑️ Выберите блюдо для удаления из стоп-листа:", reply_markup=reply_markup)
-            else:
-                await query.edit_message_text(text="⚠️ Блюдо удалено из стоп-листа, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\n🗑️ Выберите блюдо для удаления из стоп-листа:", reply_markup=reply_markup)
+        reply_markup = get_remove_keyboard(stop_list, menu)
+        
+        if success:
+            await query.edit_message_text(text="🗑️ Выберите блюдо для удаления из стоп-листа:", reply_markup=reply_markup)
         else:
-            await query.answer(f"⚠️ Блюдо ID {dish_id} не найдено в стоп-листе.")
-            await button_handler(update, context)  # Вернуть в меню стоп-листа
+            await query.edit_message_text(text="⚠️ Блюдо удалено из стоп-листа, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\n🗑️ Выберите блюдо для удаления из стоп-листа:", reply_markup=reply_markup)
+    else:
+        await query.answer(f"⚠️ Блюдо ID {dish_id} не найдено в стоп-листе.")
+        await on_remove_from_stop(update, context)  # Вернуть в меню стоп-листа
 
 
-    # Включение всех блюд (очистка стоп-листа)
-    elif data == "enable_all_dishes":
-        # Очищаем стоп-лист
-        _, delivery_status = await load_status_from_gist_or_local()
-        success = await save_status_to_gist_or_local([], delivery_status)
+# Включение всех блюд (очистка стоп-листа)
+@callback_action("enable_all_dishes", "ea")
+async def on_enable_all_dishes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Очищаем стоп-лист
+    _, delivery_status = await load_status_from_gist_or_local()
+    success = await save_status_to_gist_or_local([], delivery_status, user_id=update.effective_user.id)
+    
+    if success:
+        message = "✅ Все блюда включены (стоп-лист очищен)!\n\nВыберите следующее действие:"
+    else:
+        message = "⚠️ Все блюда включены (стоп-лист очищен), но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:"
         
-        if success:
-            message = "✅ Все блюда включены (стоп-лист очищен)!\n\nВыберите следующее действие:"
-        else:
-            message = "⚠️ Все блюда включены (стоп-лист очищен), но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:"
-            
-        await query.edit_message_text(text=message)
-        await start_command(update, context)  # Вернуть в главное меню
-
-
-    # Управление доставкой
-    elif data == "toggle_delivery":
-        delivery_disabled = await is_delivery_disabled()
-        if delivery_disabled:
-            # Включаем доставку
-            stop_list, _ = await load_status_from_gist_or_local()
-            delivery_status = {"disabled_until": None}
-            success = await save_status_to_gist_or_local(stop_list, delivery_status)
-            
-            if success:
-                await query.edit_message_text(text="✅ Доставка успешно включена!\n\nВыберите следующее действие:")
-            else:
-                await query.edit_message_text(text="⚠️ Доставка включена, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:")
-            await start_command(update, context)
-        else:
-            keyboard = [
-                [InlineKeyboardButton("1 час", callback_data="delivery_off_1")],
-                [InlineKeyboardButton("2 часа", callback_data="delivery_off_2")],
-                [InlineKeyboardButton("4 часа", callback_data="delivery_off_4")],
-                [InlineKeyboardButton("8 часов", callback_data="delivery_off_8")],
-                [InlineKeyboardButton("24 часа", callback_data="delivery_off_24")],
-                [InlineKeyboardButton("Другая дата", callback_data="delivery_date_picker")],
-                [InlineKeyboardButton("<< Назад", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(text="⏱️ Выберите, на сколько времени отключить доставку:", reply_markup=reply_markup)
-
-    # Отключение доставки на определенное время
-    elif data.startswith("delivery_off_"):
-        hours_str = data[13:]
-        try:
-            hours = int(hours_str)
-        except ValueError:
-            await query.edit_message_text(text="❌ Ошибка: некорректное количество часов.")
-            return
+    await query.edit_message_text(text=message)
+    await start_command(update, context)  # Вернуть в главное меню
+
 
-        disabled_until = datetime.now() + timedelta(hours=hours)
+# Управление доставкой
+@callback_action("toggle_delivery", "td")
+async def on_toggle_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    delivery_disabled = await is_delivery_disabled()
+    if delivery_disabled:
+        # Включаем доставку
         stop_list, _ = await load_status_from_gist_or_local()
-        delivery_status = {"disabled_until": disabled_until.isoformat()}
-        success = await save_status_to_gist_or_local(stop_list, delivery_status)
+        delivery_status = {"disabled_until": None}
+        success = await save_status_to_gist_or_local(stop_list, delivery_status, user_id=update.effective_user.id)
         
         if success:
-            message = f"🚫 Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}!\n\nВыберите следующее действие:"
+            await query.edit_message_text(text="✅ Доставка успешно включена!\n\nВыберите следующее действие:")
         else:
-            message = f"⚠️ Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:"
-            
-        await query.edit_message_text(
-            text=message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("<< Назад", callback_data="back_to_main")]])
-        )
-    
-    # Выбор даты для отключения доставки
-    elif data == "delivery_date_picker":
+            await query.edit_message_text(text="⚠️ Доставка включена, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:")
+        await start_command(update, context)
+    else:
         keyboard = [
-            [InlineKeyboardButton("1 день", callback_data="delivery_date_1")],
-            [InlineKeyboardButton("3 дня", callback_data="delivery_date_3")],
-            [InlineKeyboardButton("1 неделя", callback_data="delivery_date_7")],
-            [InlineKeyboardButton("2 недели", callback_data="delivery_date_14")],
-            [InlineKeyboardButton("1 месяц", callback_data="delivery_date_30")],
-            [InlineKeyboardButton("<< Назад", callback_data="toggle_delivery")]
+            [InlineKeyboardButton("1 час", callback_data=encode_callback("delivery_off", 1))],
+            [InlineKeyboardButton("2 часа", callback_data=encode_callback("delivery_off", 2))],
+            [InlineKeyboardButton("4 часа", callback_data=encode_callback("delivery_off", 4))],
+            [InlineKeyboardButton("8 часов", callback_data=encode_callback("delivery_off", 8))],
+            [InlineKeyboardButton("24 часа", callback_data=encode_callback("delivery_off", 24))],
+            [InlineKeyboardButton("Другая дата", callback_data=encode_callback("delivery_date_picker"))],
+            [InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text="📅 Выберите срок отключения доставки:", reply_markup=reply_markup)
-    
-    # Отключение доставки на фиксированный срок
-    elif data.startswith("delivery_date_"):
-        days_str = data[14:]
-        try:
-            days = int(days_str)
-        except ValueError:
-            await query.edit_message_text(text="❌ Ошибка: некорректное количество дней.")
-            return
+        await query.edit_message_text(text="⏱️ Выберите, на сколько времени отключить доставку:", reply_markup=reply_markup)
 
-        disabled_until = datetime.now() + timedelta(days=days)
-        stop_list, _ = await load_status_from_gist_or_local()
-        delivery_status = {"disabled_until": disabled_until.isoformat()}
-        success = await save_status_to_gist_or_local(stop_list, delivery_status)
-        
-        if success:
-            message = f"🚫 Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}!\n\nВыберите следующее действие:"
-        else:
-            message = f"⚠️ Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:"
-            
-        await query.edit_message_text(
-            text=message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("<< Назад", callback_data="back_to_main")]])
-        )
+
+# Отключение доставки на определенное время
+@callback_action("delivery_off", "do", int)
+async def on_delivery_off(update: Update, context: ContextTypes.DEFAULT_TYPE, hours: int):
+    query = update.callback_query
+    disabled_until = datetime.now() + timedelta(hours=hours)
+    stop_list, _ = await load_status_from_gist_or_local()
+    delivery_status = {"disabled_until": disabled_until.isoformat()}
+    success = await save_status_to_gist_or_local(stop_list, delivery_status, user_id=update.effective_user.id)
     
-    # Ввод собственной даты
-    elif data == "delivery_custom_date":
-        await query.edit_message_text(
-            "📅 Введите дату и время отключения доставки в формате:\n\nДД.ММ.ГГГГ ЧЧ:ММ\n\nПример: 25.12.2025 18:00",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("<< Назад", callback_data="delivery_date_picker")]
-            ])
-        )
-        context.user_data['awaiting_custom_date'] = True
+    if success:
+        message = f"🚫 Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}!\n\nВыберите следующее действие:"
+    else:
+        message = f"⚠️ Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:"
+        
+    await query.edit_message_text(
+        text=message,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))]])
+    )
+
+
+# Выбор даты для отключения доставки
+@callback_action("delivery_date_picker", "dp")
+async def on_delivery_date_picker(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    keyboard = [
+        [InlineKeyboardButton("1 день", callback_data=encode_callback("delivery_date", 1))],
+        [InlineKeyboardButton("3 дня", callback_data=encode_callback("delivery_date", 3))],
+        [InlineKeyboardButton("1 неделя", callback_data=encode_callback("delivery_date", 7))],
+        [InlineKeyboardButton("2 недели", callback_data=encode_callback("delivery_date", 14))],
+        [InlineKeyboardButton("1 месяц", callback_data=encode_callback("delivery_date", 30))],
+        [InlineKeyboardButton("Своя дата", callback_data=encode_callback("delivery_custom_date"))],
+        [InlineKeyboardButton("<< Назад", callback_data=encode_callback("toggle_delivery"))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(text="📅 Выберите срок отключения доставки:", reply_markup=reply_markup)
+
+
+# Отключение доставки на фиксированный срок
+@callback_action("delivery_date", "dd", int)
+async def on_delivery_date(update: Update, context: ContextTypes.DEFAULT_TYPE, days: int):
+    query = update.callback_query
+    disabled_until = datetime.now() + timedelta(days=days)
+    stop_list, _ = await load_status_from_gist_or_local()
+    delivery_status = {"disabled_until": disabled_until.isoformat()}
+    success = await save_status_to_gist_or_local(stop_list, delivery_status, user_id=update.effective_user.id)
     
-    # Возврат в главное меню
-    elif data == "back_to_main":
-        context.user_data.pop('awaiting_new_pin', None)  # Сбрасываем состояние ожидания нового пин-кода
-        context.user_data.pop('awaiting_custom_date', None)  # Сбрасываем состояние ожидания даты
-        await start_command(update, context)
+    if success:
+        message = f"🚫 Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}!\n\nВыберите следующее действие:"
+    else:
+        message = f"⚠️ Доставка отключена до {disabled_until.strftime('%d.%m.%Y %H:%M')}, но не удалось сохранить изменения на сервере. Изменения сохранены локально.\n\nВыберите следующее действие:"
+        
+    await query.edit_message_text(
+        text=message,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))]])
+    )
+
+
+# Ввод собственной даты
+@callback_action("delivery_custom_date", "dx")
+async def on_delivery_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(
+        "📅 Введите дату и время отключения доставки в формате:\n\nДД.ММ.ГГГГ ЧЧ:ММ\n\nПример: 25.12.2025 18:00",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("<< Назад", callback_data=encode_callback("delivery_date_picker"))]
+        ])
+    )
+    set_session_state(update.effective_user.id, "custom_date")
+
+
+# Возврат в главное меню
+@callback_action("back_to_main", "m")
+async def on_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_session_state(update.effective_user.id, None)  # Сбрасываем ожидание ввода (пин-код, дата, файл меню)
+    await start_command(update, context)
 
 
 # --- Обработчик ввода собственной даты ---
+@profiled_handler
 async def handle_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -680,13 +1509,6 @@ async def handle_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await request_pin(update, context)
         return
 
-    # Проверяем, ожидаем ли мы ввод даты
-    if not context.user_data.get('awaiting_custom_date'):
-        # Если пользователь не ожидает ввода даты, проверяем, не ожидаем ли мы пин-код
-        if not await is_authenticated(user_id):
-            await handle_pin(update, context)
-        return
-
     date_input = update.message.text.strip()
     
     try:
@@ -698,7 +1520,7 @@ async def handle_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text(
                 "❌ Ошибка: дата не может быть в прошлом.\n\nВведите дату и время отключения доставки в формате:\n\nДД.ММ.ГГГГ ЧЧ:ММ\n\nПример: 25.12.2025 18:00",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("<< Назад", callback_data="delivery_date_picker")]
+                    [InlineKeyboardButton("<< Назад", callback_data=encode_callback("delivery_date_picker"))]
                 ])
             )
             return
@@ -706,7 +1528,7 @@ async def handle_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Сохраняем статус
         stop_list, _ = await load_status_from_gist_or_local()
         delivery_status = {"disabled_until": parsed_datetime.isoformat()}
-        success = await save_status_to_gist_or_local(stop_list, delivery_status)
+        success = await save_status_to_gist_or_local(stop_list, delivery_status, user_id=update.effective_user.id)
         
         if success:
             message = f"🚫 Доставка отключена до {parsed_datetime.strftime('%d.%m.%Y %H:%M')}!"
@@ -715,21 +1537,458 @@ async def handle_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         await update.message.reply_text(
             text=message,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("<< Назад", callback_data="back_to_main")]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))]])
         )
         
         # Сбрасываем состояние ожидания даты
-        context.user_data.pop('awaiting_custom_date', None)
+        set_session_state(user_id, None)
         
     except ValueError:
         await update.message.reply_text(
             "❌ Неверный формат даты.\n\nВведите дату и время отключения доставки в формате:\n\nДД.ММ.ГГГГ ЧЧ:ММ\n\nПример: 25.12.2025 18:00",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("<< Назад", callback_data="delivery_date_picker")]
+                [InlineKeyboardButton("<< Назад", callback_data=encode_callback("delivery_date_picker"))]
             ])
         )
 
 
+# --- Единый обработчик текстовых сообщений ---
+# Состояние сессии -> обработчик текста, который ожидается от пользователя
+text_input_handlers = {
+    "custom_date": handle_custom_date,
+}
+
+async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+
+    # Неаутентифицированный пользователь может ввести только пин-код
+    if not await is_authenticated(user_id):
+        await handle_pin(update, context)
+        return
+
+    handler = text_input_handlers.get(get_session_state(user_id))
+    if handler is None:
+        # Ввод не ожидается - показываем главное меню
+        await start_command(update, context)
+        return
+    await handler(update, context)
+
+
+# --- Команда /history: журнал изменений (только для STORAGE_BACKEND=sqlite) ---
+HISTORY_MAX_DAYS = 3650  # Максимальная глубина запросов к журналу
+TELEGRAM_MESSAGE_LIMIT = 4096
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+HISTORY_ACTION_LABELS = {
+    "stop_add": "➕ в стоп-лист",
+    "stop_remove": "➖ из стоп-листа",
+    "delivery_off": "🚫 доставка отключена",
+    "delivery_on": "✅ доставка включена",
+}
+
+def format_duration(seconds: float) -> str:
+    hours, remainder = divmod(int(seconds), 3600)
+    return f"{hours} ч {remainder // 60} мин"
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Проверяем аутентификацию
+    if not await is_authenticated(user_id):
+        await request_pin(update, context)
+        return
+
+    if STORAGE_BACKEND != "sqlite":
+        await update.effective_message.reply_text("ℹ️ История доступна только при STORAGE_BACKEND=sqlite.")
+        return
+
+    # Формат: /history [ID блюда] [количество дней]
+    args = context.args or []
+    try:
+        dish_id = int(args[0]) if args else None
+        days = int(args[1]) if len(args) > 1 else 7
+        if not 1 <= days <= HISTORY_MAX_DAYS or (dish_id is not None and abs(dish_id) > SQLITE_MAX_INTEGER):
+            raise ValueError
+    except ValueError:
+        await update.effective_message.reply_text(f"❌ Формат: /history [ID блюда] [количество дней от 1 до {HISTORY_MAX_DAYS}]\n\nПример: /history 16 7")
+        return
+
+    end = datetime.now()
+    start = end - timedelta(days=days)
+    rows, unavailable = await query_history(start, end, dish_id)
+
+    dish_names = {dish['id']: dish['name'] for dishes in load_menu_data().values() for dish in dishes}
+    lines = []
+    if dish_id is None:
+        lines.append(f"📜 Изменения за последние {days} дн.:")
+    else:
+        lines.append(f"📜 Блюдо '{dish_names.get(dish_id, f'ID {dish_id}')}' за последние {days} дн.:")
+        lines.append(f"⏳ В стоп-листе: {format_duration(unavailable)}")
+
+    if not rows:
+        lines.append("\nИзменений нет.")
+    for ts, event_user_id, action, event_dish_id, value in rows:
+        line = f"{datetime.fromisoformat(ts).strftime('%d.%m %H:%M')} {HISTORY_ACTION_LABELS.get(action, action)}"
+        if event_dish_id is not None:
+            line += f" {dish_names.get(event_dish_id, f'ID {event_dish_id}')}"
+        if action == "delivery_off" and value:
+            line += f" до {datetime.fromisoformat(value).strftime('%d.%m.%Y %H:%M')}"
+        line += f" (пользователь {event_user_id})" if event_user_id is not None else " (начальное состояние)"
+        lines.append(line)
+
+    # Обрезаем ответ по длине, чтобы уложиться в лимит сообщения Telegram
+    text = ""
+    for position, line in enumerate(lines):
+        tail = f"\n... и еще {len(lines) - position}"
+        if len(text) + 1 + len(line) + len(tail) > TELEGRAM_MESSAGE_LIMIT:
+            text += tail
+            break
+        text += ("\n" if text else "") + line
+    await update.effective_message.reply_text(text)
+
+
+# --- Отчеты по доступности (только для STORAGE_BACKEND=sqlite) ---
+def _build_report_sync(start, end):
+    """Строит отчет за период одним проходом по событиям, упорядоченным по времени"""
+    conn = sqlite_connect()
+    try:
+        start_ts = start.isoformat(timespec="seconds")
+        end_ts = end.isoformat(timespec="seconds")
+        dishes = {}  # ID блюда -> {"stops": ..., "unavailable": ..., "stopped_since": ...}
+        delivery = {"pauses": 0, "unavailable": 0.0}
+        delivery_off_since = None
+        delivery_off_until = None
+
+        def dish_stats(dish_id):
+            return dishes.setdefault(dish_id, {"stops": 0, "unavailable": 0.0, "stopped_since": None})
+
+        # Состояние на начало периода - по последнему событию каждого блюда до него
+        for dish_id, action in conn.execute(
+            "SELECT dish_id, action FROM events WHERE id IN ("
+            "SELECT MAX(id) FROM events WHERE dish_id IS NOT NULL AND ts < ? GROUP BY dish_id)",
+            (start_ts,)
+        ):
+            if action == "stop_add":
+                dish_stats(dish_id)["stopped_since"] = start
+
+        last_delivery = conn.execute(
+            "SELECT action, value FROM events WHERE action IN ('delivery_off', 'delivery_on') AND ts < ? "
+            "ORDER BY ts DESC, id DESC LIMIT 1",
+            (start_ts,)
+        ).fetchone()
+        if last_delivery and last_delivery[0] == "delivery_off" and last_delivery[1]:
+            delivery_off_since = start
+            delivery_off_until = datetime.fromisoformat(last_delivery[1])
+
+        # Курсор читается построчно, поэтому память не зависит от длины истории
+        for ts, user_id, action, dish_id, value in conn.execute(
+            "SELECT ts, user_id, action, dish_id, value FROM events WHERE ts >= ? AND ts <= ? ORDER BY ts, id",
+            (start_ts, end_ts)
+        ):
+            moment = datetime.fromisoformat(ts)
+            if action == "stop_add":
+                stats = dish_stats(dish_id)
+                # Открывающие события начального состояния (без пользователя) остановками не считаются
+                if user_id is not None:
+                    stats["stops"] += 1
+                if stats["stopped_since"] is None:
+                    stats["stopped_since"] = moment
+            elif action == "stop_remove":
+                stats = dish_stats(dish_id)
+                if stats["stopped_since"] is not None:
+                    stats["unavailable"] += (moment - stats["stopped_since"]).total_seconds()
+                    stats["stopped_since"] = None
+            elif action in ("delivery_off", "delivery_on"):
+                if delivery_off_since is not None:
+                    closed_at = min(moment, delivery_off_until)
+                    delivery["unavailable"] += max((closed_at - delivery_off_since).total_seconds(), 0)
+                    delivery_off_since = None
+                if action == "delivery_off" and value:
+                    delivery["pauses"] += 1
+                    delivery_off_since = moment
+                    delivery_off_until = datetime.fromisoformat(value)
+
+        # Закрываем интервалы, которые еще не завершились к концу периода
+        finish = min(end, datetime.now())
+        for stats in dishes.values():
+            if stats["stopped_since"] is not None:
+                stats["unavailable"] += max((finish - stats["stopped_since"]).total_seconds(), 0)
+        if delivery_off_since is not None:
+            delivery["unavailable"] += max((min(finish, delivery_off_until) - delivery_off_since).total_seconds(), 0)
+
+        return dishes, delivery
+    finally:
+        conn.close()
+
+async def build_availability_report(start, end):
+    """Строит отчет по доступности блюд и доставки вне цикла событий"""
+    dishes, delivery = await asyncio.to_thread(_build_report_sync, start, end)
+
+    dish_info = {
+        dish['id']: (dish['name'], category_map.get(category, category))
+        for category, menu_dishes in load_menu_data().items()
+        for dish in menu_dishes
+    }
+    dish_rows = []
+    categories = {}
+    for dish_id, stats in dishes.items():
+        name, category = dish_info.get(dish_id, (f"Блюдо ID {dish_id}", "Не в меню"))
+        dish_rows.append((dish_id, name, category, stats["stops"], stats["unavailable"]))
+        category_stats = categories.setdefault(category, [0, 0.0])
+        category_stats[0] += stats["stops"]
+        category_stats[1] += stats["unavailable"]
+
+    dish_rows.sort(key=lambda row: (-row[3], -row[4]))
+    category_rows = sorted(
+        ((category, stops, unavailable) for category, (stops, unavailable) in categories.items()),
+        key=lambda row: -row[2]
+    )
+    return dish_rows, category_rows, delivery
+
+def format_report_csv(dish_rows, category_rows, delivery):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["section", "id", "name", "category", "stops", "unavailable_hours"])
+    for dish_id, name, category, stops, unavailable in dish_rows:
+        writer.writerow(["dish", dish_id, name, category, stops, f"{unavailable / 3600:.2f}"])
+    for category, stops, unavailable in category_rows:
+        writer.writerow(["category", "", "", category, stops, f"{unavailable / 3600:.2f}"])
+    writer.writerow(["delivery", "", "", "", delivery["pauses"], f"{delivery['unavailable'] / 3600:.2f}"])
+    return output.getvalue()
+
+def format_report_markdown(dish_rows, category_rows, delivery, start, end):
+    lines = [
+        f"# Отчет по доступности {start.strftime('%d.%m.%Y')} - {end.strftime('%d.%m.%Y')}",
+        "",
+        f"Доставка приостанавливалась {delivery['pauses']} раз, всего {format_duration(delivery['unavailable'])}.",
+        "",
+        "## Блюда",
+        "",
+        "| ID | Блюдо | Категория | Остановок | В стоп-листе |",
+        "|---|---|---|---|---|",
+    ]
+    lines += [
+        f"| {dish_id} | {name} | {category} | {stops} | {format_duration(unavailable)} |"
+        for dish_id, name, category, stops, unavailable in dish_rows
+    ]
+    lines += [
+        "",
+        "## Категории",
+        "",
+        "| Категория | Остановок | В стоп-листе |",
+        "|---|---|---|",
+    ]
+    lines += [
+        f"| {category} | {stops} | {format_duration(unavailable)} |"
+        for category, stops, unavailable in category_rows
+    ]
+    return "\n".join(lines) + "\n"
+
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Проверяем аутентификацию
+    if not await is_authenticated(user_id):
+        await request_pin(update, context)
+        return
+
+    if STORAGE_BACKEND != "sqlite":
+        await update.effective_message.reply_text("ℹ️ Отчеты доступны только при STORAGE_BACKEND=sqlite.")
+        return
+
+    # Формат: /report [количество дней] [csv|md]
+    args = context.args or []
+    try:
+        days = int(args[0]) if args else 7
+        if not 1 <= days <= HISTORY_MAX_DAYS:
+            raise ValueError
+    except ValueError:
+        await update.effective_message.reply_text(f"❌ Формат: /report [количество дней от 1 до {HISTORY_MAX_DAYS}] [csv|md]\n\nПример: /report 7 csv")
+        return
+    report_format = args[1].lower() if len(args) > 1 else "md"
+
+    end = datetime.now()
+    start = end - timedelta(days=days)
+    dish_rows, category_rows, delivery = await build_availability_report(start, end)
+
+    if report_format == "csv":
+        content = format_report_csv(dish_rows, category_rows, delivery)
+        filename = f"report_{start.strftime('%Y%m%d')}_{end.strftime('%Y%m%d')}.csv"
+    else:
+        content = format_report_markdown(dish_rows, category_rows, delivery, start, end)
+        filename = f"report_{start.strftime('%Y%m%d')}_{end.strftime('%Y%m%d')}.md"
+
+    await update.effective_message.reply_document(
+        document=io.BytesIO(content.encode("utf-8")),
+        filename=filename,
+        caption=f"📊 Отчет по доступности за {days} дн."
+    )
+
+
+# --- Команда /profile: управление профилированием ---
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global profiling_enabled, PROFILE_SAMPLE_RATE
+    user_id = update.effective_user.id
+    
+    # Проверяем аутентификацию
+    if not await is_authenticated(user_id):
+        await request_pin(update, context)
+        return
+
+    # Формат: /profile [on [доля] | off | dump]
+    args = context.args or []
+    action = args[0].lower() if args else ""
+
+    if action == "on":
+        if len(args) > 1:
+            try:
+                rate = float(args[1])
+            except ValueError:
+                rate = -1
+            if not 0 < rate <= 1:
+                await update.effective_message.reply_text("❌ Доля обновлений должна быть числом от 0 до 1.\n\nПример: /profile on 0.25")
+                return
+            PROFILE_SAMPLE_RATE = rate
+        profiling_enabled = True
+        await update.effective_message.reply_text(f"⏱️ Профилирование включено, доля обновлений: {PROFILE_SAMPLE_RATE:g}")
+    elif action in ("off", "dump"):
+        if action == "off":
+            profiling_enabled = False
+        report = build_profile_report()
+        await asyncio.to_thread(write_profile_report, report)
+        lines = [f"📈 Трасс: {report['sampled_updates']}, сохранено в {PROFILE_OUTPUT_FILE}"]
+        for name, stats in list(report["stats"].items())[:10]:
+            lines.append(f"{name}: {stats['count']} × {stats['avg_ms']:.0f} мс (макс. {stats['max_ms']:.0f} мс)")
+        if action == "off":
+            lines.insert(0, "⏹️ Профилирование выключено")
+        await update.effective_message.reply_text("\n".join(lines))
+    else:
+        status = "включено" if profiling_enabled else "выключено"
+        await update.effective_message.reply_text(
+            f"⏱️ Профилирование {status}, доля обновлений: {PROFILE_SAMPLE_RATE:g}, трасс: {profile_sampled}\n"
+            f"💾 Сохранения в Gist - {format_gist_save_stats()}\n\n"
+            "Команды: /profile on [доля], /profile off, /profile dump"
+        )
+
+
+# --- Команды /menu_upload и /menu_reload: обновление меню без перезапуска ---
+MENU_UPLOAD_MAX_BYTES = 1024 * 1024
+
+async def apply_menu_and_report(new_state, diff, warnings):
+    """Подменяет кэш заранее собранным меню и формирует отчет об изменениях"""
+    swap_menu_state(new_state)
+    stop_list, _ = await load_status_from_gist_or_local()
+    orphaned = [dish_id for dish_id in stop_list if dish_id not in new_state["dish_index"]]
+
+    added = sum(len(changes["added"]) for changes in diff.values())
+    removed = sum(len(changes["removed"]) for changes in diff.values())
+    changed = sum(len(changes["changed"]) for changes in diff.values())
+    lines = [
+        "✅ Меню обновлено.",
+        f"Блюд добавлено: {added}, удалено: {removed}, изменено: {changed}",
+        f"Пересобрано категорий: {len(diff)}" + (f" ({', '.join(sorted(diff))})" if diff else ""),
+    ]
+    if orphaned:
+        lines.append(f"\n⚠️ ID в стоп-листе, которых нет в меню: {', '.join(map(str, orphaned))}")
+    if warnings:
+        lines.append("\n⚠️ Предупреждения:")
+        lines += [f"• {warning}" for warning in warnings[:20]]
+    return "\n".join(lines)
+
+def format_menu_errors(errors):
+    lines = ["❌ Меню не принято:"]
+    lines += [f"• {error}" for error in errors[:20]]
+    if len(errors) > 20:
+        lines.append(f"... и еще {len(errors) - 20}")
+    return "\n".join(lines)
+
+def write_menu_file(data):
+    """Атомарно записывает файл меню"""
+    temp_file = MENU_DATA_FILE + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, MENU_DATA_FILE)
+
+async def menu_upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Проверяем аутентификацию
+    if not await is_authenticated(user_id):
+        await request_pin(update, context)
+        return
+
+    set_session_state(user_id, "menu_upload")
+    await update.effective_message.reply_text(
+        "📄 Отправьте файл меню в формате JSON (как menu_data.json).",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))]
+        ])
+    )
+
+async def handle_menu_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Проверяем аутентификацию
+    if not await is_authenticated(user_id):
+        await request_pin(update, context)
+        return
+
+    if get_session_state(user_id) != "menu_upload":
+        return
+
+    document = update.message.document
+    if document.file_size and document.file_size > MENU_UPLOAD_MAX_BYTES:
+        await update.message.reply_text(f"❌ Файл слишком большой (максимум {MENU_UPLOAD_MAX_BYTES // 1024} КБ).")
+        return
+
+    telegram_file = await document.get_file()
+    content = await telegram_file.download_as_bytearray()
+    try:
+        new_data = json.loads(bytes(content).decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        await update.message.reply_text(f"❌ Файл не является корректным JSON: {e}")
+        return
+
+    errors, warnings = validate_menu(new_data)
+    if errors:
+        await update.message.reply_text(format_menu_errors(errors))
+        return
+
+    # Сначала собираем кэш: если сборка упадет, файл на диске останется прежним
+    load_menu_data()
+    new_state, diff = build_menu_state(new_data)
+    await asyncio.to_thread(write_menu_file, new_data)
+    set_session_state(user_id, None)
+    report = await apply_menu_and_report(new_state, diff, warnings)
+    print(f"✅ Меню обновлено пользователем {user_id}")
+    await update.message.reply_text(
+        report,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))]])
+    )
+
+async def menu_reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Проверяем аутентификацию
+    if not await is_authenticated(user_id):
+        await request_pin(update, context)
+        return
+
+    try:
+        new_data = await asyncio.to_thread(read_menu_file)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        await update.effective_message.reply_text(f"❌ {MENU_DATA_FILE} не является корректным JSON: {e}")
+        return
+
+    errors, warnings = validate_menu(new_data)
+    if errors:
+        await update.effective_message.reply_text(format_menu_errors(errors))
+        return
+
+    load_menu_data()
+    new_state, diff = build_menu_state(new_data)
+    await update.effective_message.reply_text(await apply_menu_and_report(new_state, diff, warnings))
+
+
 # --- category_map из React-кода ---
 category_map = {
   "breakfast": "Завтраки",
@@ -746,35 +2005,29 @@ category_map = {
 }
 
 # --- Вспомогательная функция для получения клавиатуры категории ---
-async def get_category_keyboard(category_key, menu_data, stop_list):
+async def get_category_keyboard(category_key, menu, stop_list):
     category_label = category_map.get(category_key, "Неизвестная категория")
     keyboard = []
-    dishes_in_category = menu_data.get(category_key, [])
+    buttons_in_category = menu["category_buttons"].get(category_key, [])
     
     # Сортировка блюд сначала доступные, потом в стоп-листе
-    available_dishes = [dish for dish in dishes_in_category if dish['id'] not in stop_list]
-    unavailable_dishes = [dish for dish in dishes_in_category if dish['id'] in stop_list]
+    available_buttons = [button for button in buttons_in_category if button[0] not in stop_list]
+    unavailable_buttons = [button for button in buttons_in_category if button[0] in stop_list]
     
     # Сначала добавляем доступные блюда
-    for dish in available_dishes:
-        dish_id = dish['id']
-        dish_name = dish['name']
-        dish_price = dish['price']
+    for _, dish_name, dish_price, callback_data in available_buttons:
         button_text = f"{dish_name} ({dish_price}₽)"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"dish_add_{dish_id}_{category_key}")])
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
     
     # Затем добавляем недоступные блюда
-    for dish in unavailable_dishes:
-        dish_id = dish['id']
-        dish_name = dish['name']
-        dish_price = dish['price']
+    for _, dish_name, dish_price, callback_data in unavailable_buttons:
         button_text = f"{dish_name} ({dish_price}₽) ❌"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"dish_add_{dish_id}_{category_key}")])
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
 
     # Кнопка отключения всей категории
-    keyboard.append([InlineKeyboardButton(f"❌ Отключить все '{category_label}' ({len(dishes_in_category)} шт.)", callback_data=f"disable_cat_{category_key}")])
-    keyboard.append([InlineKeyboardButton("<< Назад к категориям", callback_data="add_to_stop")])
-    keyboard.append([InlineKeyboardButton("<< Назад", callback_data="back_to_main")])
+    keyboard.append([InlineKeyboardButton(f"❌ Отключить все '{category_label}' ({len(buttons_in_category)} шт.)", callback_data=encode_callback("disable_cat", category_key))])
+    keyboard.append([InlineKeyboardButton("<< Назад к категориям", callback_data=encode_callback("add_to_stop"))])
+    keyboard.append([InlineKeyboardButton("<< Назад", callback_data=encode_callback("back_to_main"))])
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -787,6 +2040,9 @@ async def initialize_bot():
             print(error)
         return False, None
     
+    # Восстанавливаем сессии, чтобы после перезапуска не вводить пин-код заново
+    load_sessions()
+    
     # Проверяем доступ к Gist
     is_accessible, message = await check_gist_access()
     if not is_accessible:
@@ -798,8 +2054,15 @@ async def initialize_bot():
         else:
             print("❌ Не удалось восстановить Gist. Используем локальные файлы для хранения данных.")
     
+    # Восстанавливаем очередь неотправленных изменений после перезапуска
+    load_outbox()
+    
+    if STORAGE_BACKEND == "sqlite":
+        print(f"🗄️ Локальное хранилище: SQLite ({SQLITE_DB_FILE})")
+        await init_sqlite_storage()
+    
     print("✅ Проверка конфигурации пройдена успешно")
-    return True, Application.builder().token(BOT_TOKEN).build()
+    return True, Application.builder().token(BOT_TOKEN).request(ProfiledRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE)).post_init(start_outbox_drainer).post_shutdown(persist_sessions).build()
 
 def main():
     """Основная функция запуска бота"""
@@ -818,9 +2081,14 @@ def main():
     
     # Добавление обработчиков
     application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("report", report_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("menu_upload", menu_upload_command))
+    application.add_handler(CommandHandler("menu_reload", menu_reload_command))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_menu_document))
     application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_pin))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_custom_date))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
     
     print("✅ Бот успешно запущен!")
     print("💬 Отправьте команду /start для начала работы")